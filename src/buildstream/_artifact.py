@@ -28,6 +28,7 @@ artifact composite interaction away from Element class
 
 """
 
+import io
 import os
 from typing import Dict, Tuple
 
@@ -62,7 +63,6 @@ class Artifact:
         self._weak_cache_key = weak_key
         self._artifactdir = context.artifactdir
         self._cas = context.get_cascache()
-        self._tmpdir = context.tmpdir
         self._proto = None
 
         self._metadata_keys = None  # Strong, strict and weak key tuple extracted from the artifact
@@ -70,6 +70,7 @@ class Artifact:
         self._metadata_workspaced = None  # Boolean of whether it's a workspaced artifact
         self._metadata_workspaced_dependencies = None  # List of which dependencies are workspaced from the artifact
         self._cached = None  # Boolean of whether the artifact is cached
+        self._low_diversity_meta = None  # Parsed low diversity metadata from the artifact
 
     # strong_key():
     #
@@ -238,40 +239,41 @@ class Artifact:
             artifact.files.CopyFrom(filesvdir._get_digest())
             size += filesvdir.get_size()
 
-        # Store public data
-        with utils._tempnamedfile_name(dir=self._tmpdir) as tmpname:
-            _yaml.roundtrip_dump(publicdata, tmpname)
-            public_data_digest = self._cas.add_object(path=tmpname)
-            artifact.public_data.CopyFrom(public_data_digest)
-            size += public_data_digest.size_bytes
+        # Store public data and metadata, these are serialized in memory
+        # and added to the CAS together.
+        #
+        public_data_buffer = _dump_yaml(publicdata)
 
         # Store low diversity metadata, this metadata must have a high
         # probability of deduplication, such as environment variables
         # and SandboxConfig.
         #
-        with utils._tempnamedfile_name(dir=self._tmpdir) as tmpname:
-            sandbox_dict = sandboxconfig.to_dict()
-            low_diversity_dict = {"environment": environment, "sandbox-config": sandbox_dict}
-            low_diversity_node = Node.from_dict(low_diversity_dict)
-
-            _yaml.roundtrip_dump(low_diversity_node, tmpname)
-            low_diversity_meta_digest = self._cas.add_object(path=tmpname)
-            artifact.low_diversity_meta.CopyFrom(low_diversity_meta_digest)
-            size += low_diversity_meta_digest.size_bytes
+        sandbox_dict = sandboxconfig.to_dict()
+        low_diversity_dict = {"environment": environment, "sandbox-config": sandbox_dict}
+        low_diversity_node = Node.from_dict(low_diversity_dict)
+        low_diversity_buffer = _dump_yaml(low_diversity_node)
 
         # Store high diversity metadata, this metadata is expected to diverge
         # for every element and as such cannot be deduplicated.
         #
-        with utils._tempnamedfile_name(dir=self._tmpdir) as tmpname:
-            # The Variables object supports being converted directly to a dictionary
-            variables_dict = dict(variables)
-            high_diversity_dict = {"variables": variables_dict}
-            high_diversity_node = Node.from_dict(high_diversity_dict)
+        # The Variables object supports being converted directly to a dictionary
+        variables_dict = dict(variables)
+        high_diversity_dict = {"variables": variables_dict}
+        high_diversity_node = Node.from_dict(high_diversity_dict)
+        high_diversity_buffer = _dump_yaml(high_diversity_node)
+
+        digests = self._cas.add_objects(buffers=[public_data_buffer, low_diversity_buffer, high_diversity_buffer])
+
+        public_data_digest, low_diversity_meta_digest, high_diversity_meta_digest = digests
+
+        artifact.public_data.CopyFrom(public_data_digest)
+        size += public_data_digest.size_bytes
+
+        artifact.low_diversity_meta.CopyFrom(low_diversity_meta_digest)
+        size += low_diversity_meta_digest.size_bytes
 
-            _yaml.roundtrip_dump(high_diversity_node, tmpname)
-            high_diversity_meta_digest = self._cas.add_object(path=tmpname)
-            artifact.high_diversity_meta.CopyFrom(high_diversity_meta_digest)
-            size += high_diversity_meta_digest.size_bytes
+        artifact.high_diversity_meta.CopyFrom(high_diversity_meta_digest)
+        size += high_diversity_meta_digest.size_bytes
 
         # store build dependencies
         for e in element._dependencies(_Scope.BUILD):
@@ -386,9 +388,7 @@ class Artifact:
     def load_sandbox_config(self) -> SandboxConfig:
 
         # Load the sandbox data from the artifact
-        artifact = self._get_proto()
-        meta_file = self._cas.objpath(artifact.low_diversity_meta)
-        data = _yaml.load(meta_file, shortname="low-diversity-meta.yaml")
+        data = self._load_low_diversity_meta()
 
         # Extract the sandbox data
         config = data.get_mapping("sandbox-config")
@@ -406,9 +406,7 @@ class Artifact:
     def load_environment(self) -> Dict[str, str]:
 
         # Load the sandbox data from the artifact
-        artifact = self._get_proto()
-        meta_file = self._cas.objpath(artifact.low_diversity_meta)
-        data = _yaml.load(meta_file, shortname="low-diversity-meta.yaml")
+        data = self._load_low_diversity_meta()
 
         # Extract the environment
         config = data.get_mapping("environment")
@@ -608,6 +606,7 @@ class Artifact:
     def reset_cached(self):
         self._proto = None
         self._cached = None
+        self._low_diversity_meta = None
 
     # set_cached()
     #
@@ -665,6 +664,25 @@ class Artifact:
 
         return artifact
 
+    # _load_low_diversity_meta()
+    #
+    # Load the low diversity metadata from the cached artifact.
+    #
+    # The environment and the sandbox configuration are both stored
+    # in this file and are usually loaded together, so the parsed
+    # metadata is kept to avoid loading the file twice.
+    #
+    # Returns:
+    #    (MappingNode): The low diversity metadata
+    #
+    def _load_low_diversity_meta(self):
+        if self._low_diversity_meta is None:
+            artifact = self._get_proto()
+            meta_file = self._cas.objpath(artifact.low_diversity_meta)
+            self._low_diversity_meta = _yaml.load(meta_file, shortname="low-diversity-meta.yaml")
+
+        return self._low_diversity_meta
+
     # _get_proto()
     #
     # Returns:
@@ -685,3 +703,19 @@ class Artifact:
             return None
 
         return digest
+
+
+# _dump_yaml()
+#
+# Serialize YAML data for storing it in the CAS.
+#
+# Args:
+#    contents (Node|dict): The data to serialize
+#
+# Returns:
+#    (bytes): The UTF-8 encoded YAML document
+#
+def _dump_yaml(contents):
+    with io.StringIO() as f:
+        _yaml.roundtrip_dump(contents, f)
+        return f.getvalue().encode("utf-8")
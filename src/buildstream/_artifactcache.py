@@ -88,7 +88,7 @@ class ArtifactCache(AssetCache):
     #     ([str]) - A list of artifact names as generated in LRU order
     #
     def list_artifacts(self, *, glob=None):
-        return [ref for _, ref in sorted(list(self._list_refs_mtimes(self._basedir, glob_expr=glob)))]
+        return [ref for _, ref in sorted(self._list_refs_mtimes(self._basedir, glob_expr=glob))]
 
     # remove():
     #
@@ -618,7 +618,7 @@ class AssetCache:
             globdir = os.path.dirname(glob_expr)
             if not any(c in "*?[" for c in globdir):
                 # path prefix contains no globbing characters so
-                # append the glob to optimise the os.walk()
+                # append the glob to limit the directories scanned
                 path = os.path.join(base_path, globdir)
 
         regexer = None
@@ -626,13 +626,11 @@ class AssetCache:
             expression = utils._glob2re(glob_expr)
             regexer = re.compile(expression)
 
-        for root, _, files in os.walk(path):
-            for filename in files:
-                ref_path = os.path.join(root, filename)
-                relative_path = os.path.relpath(ref_path, base_path)  # Relative to refs head
-                if regexer is None or regexer.match(relative_path):
-                    # Obtain the mtime (the time a file was last modified)
-                    yield (os.path.getmtime(ref_path), relative_path)
+        for entry in _scandir_files(path):
+            relative_path = os.path.relpath(entry.path, base_path)  # Relative to refs head
+            if regexer is None or regexer.match(relative_path):
+                # Obtain the mtime (the time a file was last modified)
+                yield (entry.stat().st_mtime, relative_path)
 
     # _remove_ref()
     #
@@ -655,3 +653,34 @@ class AssetCache:
             raise AssetCacheError("Could not find ref '{}'".format(ref)) from e
         except OSError as e:
             raise AssetCacheError("System error while removing ref '{}': {}".format(ref, e)) from e
+
+
+# _scandir_files()
+#
+# Recursively iterate over the files in a directory.
+#
+# Unlike os.walk() combined with os.path.getmtime(), this uses the
+# file type information returned by os.scandir() and does not need
+# to rebuild the full path of every file.
+#
+# Like os.walk(), symbolic links to directories are not followed and
+# errors listing a directory are ignored.
+#
+# Args:
+#    path (str): The directory to iterate over
+#
+# Yields:
+#    (os.DirEntry): The entries of all non-directory files
+#
+def _scandir_files(path):
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scandir_files(entry.path)
+        elif not entry.is_dir():
+            yield entry
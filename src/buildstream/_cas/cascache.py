@@ -18,10 +18,12 @@
 #  Authors:
 #        Jürg Billeter <juerg.billeter@codethink.co.uk>
 
+import collections
 import itertools
 import os
 import stat
 import contextlib
+import sys
 import time
 from typing import Optional, List
 import threading
@@ -37,10 +39,13 @@ from ..types import FastEnum, SourceRef
 from .._exceptions import CASCacheError
 
 from .casdprocessmanager import CASDProcessManager
-from .casremote import _CASBatchRead, _CASBatchUpdate, BlobNotFound
+from .casremote import _CASBatchRead, _CASBatchUpdate, BlobNotFound, _MAX_CONCURRENT_REQUESTS, _MAX_PAYLOAD_BYTES
 
 _BUFFER_SIZE = 65536
 
+# Maximum number of parsed Directory messages kept in memory
+_DIRECTORY_CACHE_SIZE = 1024
+
 
 # Refresh interval for disk usage of local cache in seconds
 _CACHE_USAGE_REFRESH = 5
@@ -75,11 +80,15 @@ class CASCache:
     ):
         self.casdir = os.path.join(path, "cas")
         self.tmpdir = os.path.join(path, "tmp")
+        self._objdir = os.path.join(self.casdir, "objects")
         os.makedirs(self.tmpdir, exist_ok=True)
 
         self._cache_usage_monitor = None
         self._cache_usage_monitor_forbidden = False
 
+        self._directory_cache = collections.OrderedDict()
+        self._directory_cache_lock = threading.Lock()
+
         self._casd_process_manager = None
         self._casd_channel = None
         if casd:
@@ -194,38 +203,11 @@ class CASCache:
     def checkout(self, dest, tree, *, can_link=False):
         os.makedirs(dest, exist_ok=True)
 
-        directory = remote_execution_pb2.Directory()
-
-        with open(self.objpath(tree), "rb") as f:
-            directory.ParseFromString(f.read())
+        directory = self._load_directory(tree)
 
         for filenode in directory.files:
-            # regular file, create hardlink
             fullpath = os.path.join(dest, filenode.name)
-
-            node_properties = filenode.node_properties
-            if node_properties.HasField("mtime"):
-                mtime = utils._parse_protobuf_timestamp(node_properties.mtime)
-            else:
-                mtime = None
-
-            if can_link and mtime is None:
-                utils.safe_link(self.objpath(filenode.digest), fullpath)
-            else:
-                utils.safe_copy(self.objpath(filenode.digest), fullpath, copystat=False)
-                if mtime is not None:
-                    utils._set_file_mtime(fullpath, mtime)
-
-            if filenode.is_executable:
-                st = os.stat(fullpath)
-                mode = st.st_mode
-                if mode & stat.S_IRUSR:
-                    mode |= stat.S_IXUSR
-                if mode & stat.S_IRGRP:
-                    mode |= stat.S_IXGRP
-                if mode & stat.S_IROTH:
-                    mode |= stat.S_IXOTH
-                os.chmod(fullpath, mode)
+            self._checkout_file(fullpath, filenode, can_link=can_link)
 
         for dirnode in directory.directories:
             fullpath = os.path.join(dest, dirnode.name)
@@ -270,7 +252,8 @@ class CASCache:
     #     (str): The path of the object
     #
     def objpath(self, digest):
-        return os.path.join(self.casdir, "objects", digest.hash[:2], digest.hash[2:])
+        h = digest.hash
+        return self._objdir + os.sep + h[:2] + os.sep + h[2:]
 
     # open():
     #
@@ -330,6 +313,11 @@ class CASCache:
         # Exactly one of the two parameters has to be specified
         assert (paths is None) != (buffers is None)
 
+        # Small buffers can be sent directly, without a round trip
+        # through temporary files
+        if buffers is not None and all(len(buffer) <= _MAX_PAYLOAD_BYTES for buffer in buffers):
+            return self._add_buffers(buffers, instance_name=instance_name)
+
         digests = []
 
         with contextlib.ExitStack() as stack:
@@ -401,10 +389,8 @@ class CASCache:
         if tree_response.status.code != code_pb2.OK:
             raise CASCacheError("Failed to capture tree {}: {}".format(path, tree_response.status.code))
 
-        treepath = self.objpath(tree_response.tree_digest)
         tree = remote_execution_pb2.Tree()
-        with open(treepath, "rb") as f:
-            tree.ParseFromString(f.read())
+        self._parse_object(tree_response.tree_digest, tree)
 
         root_directory = tree.root.SerializeToString()
 
@@ -442,16 +428,10 @@ class CASCache:
             instance_name = ""
 
         missing_blobs = dict()
-        # Limit size of FindMissingBlobs request
-        for required_blobs_group in _grouper(iter(blobs), 512):
-            request = remote_execution_pb2.FindMissingBlobsRequest(instance_name=instance_name)
-
-            for required_digest in required_blobs_group:
-                d = request.blob_digests.add()
-                d.CopyFrom(required_digest)
 
+        def collect_response(response_future):
             try:
-                response = cas.FindMissingBlobs(request)
+                response = response_future.result()
             except grpc.RpcError as e:
                 if e.code() == grpc.StatusCode.INVALID_ARGUMENT and e.details().startswith("Invalid instance name"):
                     raise CASCacheError("Unsupported buildbox-casd version: FindMissingBlobs failed") from e
@@ -462,6 +442,25 @@ class CASCache:
                 d.CopyFrom(missing_digest)
                 missing_blobs[d.hash] = d
 
+        # Keep several requests in flight rather than waiting for
+        # one round trip at a time
+        response_futures = collections.deque()
+
+        # Limit size of FindMissingBlobs request
+        for required_blobs_group in _grouper(blobs, 512):
+            request = remote_execution_pb2.FindMissingBlobsRequest(instance_name=instance_name)
+
+            add_digest = request.blob_digests.add
+            for required_digest in required_blobs_group:
+                add_digest().CopyFrom(required_digest)
+
+            response_futures.append(cas.FindMissingBlobs.future(request))
+            if len(response_futures) >= _MAX_CONCURRENT_REQUESTS:
+                collect_response(response_futures.popleft())
+
+        while response_futures:
+            collect_response(response_futures.popleft())
+
         return missing_blobs.values()
 
     # required_blobs_for_directory():
@@ -470,24 +469,39 @@ class CASCache:
     # the Digest of the toplevel Directory object.
     #
     def required_blobs_for_directory(self, directory_digest, *, excluded_subdirs=None):
-        if not excluded_subdirs:
-            excluded_subdirs = []
+        excluded_subdirs = frozenset(excluded_subdirs) if excluded_subdirs else frozenset()
 
-        # parse directory, and recursively add blobs
+        # Walk the tree breadth first, subdirectories which appear
+        # multiple times in the tree are only parsed and reported once
+        visited = set()
+        queue = collections.deque([directory_digest])
 
-        yield directory_digest
+        # Bind methods used in the loop to local names, this is a hot path
+        # for large trees
+        load_directory = self._load_directory
+        visit = visited.add
+        enqueue = queue.append
+        dequeue = queue.popleft
 
-        directory = remote_execution_pb2.Directory()
+        while queue:
+            digest = dequeue()
+            if digest.hash in visited:
+                continue
+            visit(digest.hash)
 
-        with open(self.objpath(directory_digest), "rb") as f:
-            directory.ParseFromString(f.read())
+            yield digest
 
-        for filenode in directory.files:
-            yield filenode.digest
+            directory = load_directory(digest)
 
-        for dirnode in directory.directories:
-            if dirnode.name not in excluded_subdirs:
-                yield from self.required_blobs_for_directory(dirnode.digest)
+            for filenode in directory.files:
+                yield filenode.digest
+
+            for dirnode in directory.directories:
+                if dirnode.name not in excluded_subdirs:
+                    enqueue(dirnode.digest)
+
+            # Subdirectories are only excluded at the top level
+            excluded_subdirs = frozenset()
 
     ################################################
     #             Local Private Methods            #
@@ -505,6 +519,158 @@ class CASCache:
             os.chmod(f.name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
             yield f
 
+    # _add_buffers():
+    #
+    # Write byte buffers to CAS.
+    #
+    # As the content is already in memory, the digests are computed
+    # locally and the buffers are uploaded to buildbox-casd with
+    # BatchUpdateBlobs, rather than written to temporary files which
+    # buildbox-casd then has to read back and hash.
+    #
+    # Args:
+    #     buffers (List[bytes]): Byte buffers to add, each of them must
+    #                            fit in a single request
+    #     instance_name (str): casd instance_name for remote CAS
+    #
+    # Returns:
+    #     (List[Digest]): The digests of the added objects
+    #
+    def _add_buffers(self, buffers, *, instance_name=None):
+        digests = [utils._message_digest(buffer) for buffer in buffers]
+
+        requests = []
+        request = None
+        request_size = 0
+        for digest, buffer in zip(digests, buffers):
+            if request is None or request_size + digest.size_bytes > _MAX_PAYLOAD_BYTES:
+                request = remote_execution_pb2.BatchUpdateBlobsRequest()
+                if instance_name:
+                    request.instance_name = instance_name
+                requests.append(request)
+                request_size = 0
+
+            blob_request = request.requests.add()
+            blob_request.digest.CopyFrom(digest)
+            blob_request.data = buffer
+            request_size += digest.size_bytes
+
+        cas = self.get_cas()
+
+        for request in requests:
+            response = cas.BatchUpdateBlobs(request)
+
+            if len(response.responses) != len(request.requests):
+                raise CASCacheError(
+                    "Expected {} responses from BatchUpdateBlobs, got {}".format(
+                        len(request.requests), len(response.responses)
+                    )
+                )
+
+            for blob_response in response.responses:
+                if blob_response.status.code == code_pb2.RESOURCE_EXHAUSTED:
+                    raise CASCacheError("Cache too full", reason="cache-too-full")
+                if blob_response.status.code != code_pb2.OK:
+                    raise CASCacheError(
+                        "Failed to add blob {}: {}".format(blob_response.digest.hash, blob_response.status.code)
+                    )
+
+        return digests
+
+    # _parse_object():
+    #
+    # Parse a protobuf message stored in the local cache.
+    #
+    # Objects are read without the buffered io layer, most objects
+    # parsed here are small Directory messages.
+    #
+    # Args:
+    #     digest (Digest): The digest of the object
+    #     message (Message): The message to parse the object into
+    #
+    def _parse_object(self, digest, message):
+        with open(self.objpath(digest), "rb", buffering=0) as f:
+            message.ParseFromString(f.readall())
+
+    # _load_directory():
+    #
+    # Load a Directory message from the local cache.
+    #
+    # Directory objects are content addressed and thus never change,
+    # recently used messages are kept in memory to avoid parsing
+    # directories shared by several trees over and over again.
+    #
+    # Args:
+    #     digest (Digest): The digest of the Directory object
+    #
+    # Returns:
+    #     (Directory): The parsed Directory message, which is shared
+    #                  and must not be modified
+    #
+    def _load_directory(self, digest):
+        with self._directory_cache_lock:
+            directory = self._directory_cache.get(digest.hash)
+            if directory is not None:
+                self._directory_cache.move_to_end(digest.hash)
+                return directory
+
+        directory = remote_execution_pb2.Directory()
+        self._parse_object(digest, directory)
+
+        self._cache_directory(digest, directory)
+
+        return directory
+
+    # _cache_directory():
+    #
+    # Add a parsed Directory message to the in-memory cache.
+    #
+    # Args:
+    #     digest (Digest): The digest of the Directory object
+    #     directory (Directory): The parsed Directory message, which
+    #                            must not be modified afterwards
+    #
+    def _cache_directory(self, digest, directory):
+        with self._directory_cache_lock:
+            self._directory_cache[digest.hash] = directory
+            if len(self._directory_cache) > _DIRECTORY_CACHE_SIZE:
+                self._directory_cache.popitem(last=False)
+
+    # _checkout_file():
+    #
+    # Checkout a single file.
+    #
+    # Args:
+    #     fullpath (str): The destination path
+    #     filenode (FileNode): The file to extract
+    #     can_link (bool): Whether we can create hard links in the destination
+    #
+    def _checkout_file(self, fullpath, filenode, *, can_link):
+        node_properties = filenode.node_properties
+        if node_properties.HasField("mtime"):
+            mtime = utils._parse_protobuf_timestamp(node_properties.mtime)
+        else:
+            mtime = None
+
+        if can_link and mtime is None:
+            # regular file, create hardlink
+            utils.safe_link(self.objpath(filenode.digest), fullpath)
+        else:
+            utils.safe_copy(self.objpath(filenode.digest), fullpath, copystat=False)
+            if mtime is not None:
+                utils._set_file_mtime(fullpath, mtime)
+
+        if filenode.is_executable:
+            st = os.stat(fullpath)
+            mode = st.st_mode
+            if mode & stat.S_IRUSR:
+                mode |= stat.S_IXUSR
+            if mode & stat.S_IRGRP:
+                mode |= stat.S_IXGRP
+            if mode & stat.S_IROTH:
+                mode |= stat.S_IXOTH
+            os.chmod(fullpath, mode)
+
     # _fetch_directory():
     #
     # Fetches remote directory and adds it to content addressable store.
@@ -542,9 +708,7 @@ class CASCache:
         self.fetch_blobs(remote, [digest])
 
         tree = remote_execution_pb2.Tree()
-
-        with self.open(digest, "rb") as f:
-            tree.ParseFromString(f.read())
+        self._parse_object(digest, tree)
 
         dirbuffers = [tree.root.SerializeToString()]
         for directory in tree.children:
@@ -552,6 +716,16 @@ class CASCache:
 
         dirdigests = self.add_objects(buffers=dirbuffers)
 
+        # Keep the Directory messages in memory so that walking the tree
+        # doesn't read them back from disk. They are parsed again from the
+        # buffers, as sub-messages would keep the whole Tree alive.
+        #
+        # Larger trees would only evict each other from the cache before
+        # being walked, and any useful entries along with them.
+        if len(dirbuffers) <= _DIRECTORY_CACHE_SIZE:
+            for dirdigest, dirbuffer in zip(dirdigests, dirbuffers):
+                self._cache_directory(dirdigest, remote_execution_pb2.Directory.FromString(dirbuffer))
+
         # The digest of the root directory
         return dirdigests[0]
 
@@ -708,10 +882,21 @@ class _CASCacheUsageMonitor(threading.Thread):
                 time.sleep(0.1)
 
 
-def _grouper(iterable, n):
-    while True:
-        try:
-            current = next(iterable)
-        except StopIteration:
-            return
-        yield itertools.chain([current], itertools.islice(iterable, n - 1))
+# _grouper():
+#
+# Split an iterable into tuples of at most `n` items.
+#
+# Use the C implementation of itertools.batched() where available,
+# it is only provided as of Python 3.12.
+#
+if sys.version_info >= (3, 12):
+    _grouper = itertools.batched
+else:
+
+    def _grouper(iterable, n):
+        it = iter(iterable)
+        while True:
+            group = tuple(itertools.islice(it, n))
+            if not group:
+                return
+            yield group
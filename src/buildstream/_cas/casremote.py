@@ -15,6 +15,8 @@
 #  License along with this library. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+
 import grpc
 
 from .._protos.google.rpc import code_pb2
@@ -32,6 +34,10 @@ _MAX_PAYLOAD_BYTES = 1024 * 1024
 # 80 bytes provide sufficient space for hash, size, and protobuf overhead.
 _MAX_DIGESTS = _MAX_PAYLOAD_BYTES / 80
 
+# How many requests to keep in flight at once, rather than waiting
+# for one round trip at a time.
+_MAX_CONCURRENT_REQUESTS = 16
+
 
 class BlobNotFound(CASRemoteError):
     def __init__(self, blob, msg):
@@ -101,7 +107,8 @@ class CASRemote(BaseRemote):
 class _CASBatchRead:
     def __init__(self, remote):
         self._remote = remote
-        self._requests = []
+        self._futures = collections.deque()
+        self._responses = []
         self._request = None
         self._sent = False
 
@@ -109,9 +116,12 @@ class _CASBatchRead:
         assert not self._sent
 
         if not self._request or len(self._request.blob_digests) >= _MAX_DIGESTS:
+            # Dispatch full requests right away, so that blobs are fetched
+            # while the caller is still collecting the digests of the next
+            # request, e.g. when walking a directory tree
+            self._dispatch()
             self._request = local_cas_pb2.FetchMissingBlobsRequest()
             self._request.instance_name = self._remote.local_cas_instance_name
-            self._requests.append(self._request)
 
         request_digest = self._request.blob_digests.add()
         request_digest.CopyFrom(digest)
@@ -120,14 +130,11 @@ class _CASBatchRead:
         assert not self._sent
         self._sent = True
 
-        if not self._requests:
-            return
-
-        local_cas = self._remote.cascache.get_local_cas()
-
-        for request in self._requests:
-            batch_response = local_cas.FetchMissingBlobs(request)
+        self._dispatch()
+        while self._futures:
+            self._responses.append(self._futures.popleft().result())
 
+        for batch_response in self._responses:
             for response in batch_response.responses:
                 if response.status.code == code_pb2.NOT_FOUND:
                     if missing_blobs is None:
@@ -138,16 +145,20 @@ class _CASBatchRead:
 
                     missing_blobs.append(response.digest)
 
-                if response.status.code != code_pb2.OK:
+                elif response.status.code != code_pb2.OK:
                     raise CASRemoteError(
                         "Failed to download blob {}: {}".format(response.digest.hash, response.status.code)
                     )
-                if response.digest.size_bytes != len(response.data):
-                    raise CASRemoteError(
-                        "Failed to download blob {}: expected {} bytes, received {} bytes".format(
-                            response.digest.hash, response.digest.size_bytes, len(response.data)
-                        )
-                    )
+
+    def _dispatch(self):
+        if self._request is not None:
+            # Wait for the oldest request before exceeding the limit
+            if len(self._futures) >= _MAX_CONCURRENT_REQUESTS:
+                self._responses.append(self._futures.popleft().result())
+
+            local_cas = self._remote.cascache.get_local_cas()
+            self._futures.append(local_cas.FetchMissingBlobs.future(self._request))
+            self._request = None
 
 
 # Represents a batch of blobs queued for upload.
@@ -155,7 +166,8 @@ class _CASBatchRead:
 class _CASBatchUpdate:
     def __init__(self, remote):
         self._remote = remote
-        self._requests = []
+        self._futures = collections.deque()
+        self._responses = []
         self._request = None
         self._sent = False
 
@@ -163,9 +175,10 @@ class _CASBatchUpdate:
         assert not self._sent
 
         if not self._request or len(self._request.blob_digests) >= _MAX_DIGESTS:
+            # Dispatch full requests right away, as for _CASBatchRead
+            self._dispatch()
             self._request = local_cas_pb2.UploadMissingBlobsRequest()
             self._request.instance_name = self._remote.local_cas_instance_name
-            self._requests.append(self._request)
 
         request_digest = self._request.blob_digests.add()
         request_digest.CopyFrom(digest)
@@ -174,14 +187,11 @@ class _CASBatchUpdate:
         assert not self._sent
         self._sent = True
 
-        if not self._requests:
-            return
-
-        local_cas = self._remote.cascache.get_local_cas()
-
-        for request in self._requests:
-            batch_response = local_cas.UploadMissingBlobs(request)
+        self._dispatch()
+        while self._futures:
+            self._responses.append(self._futures.popleft().result())
 
+        for batch_response in self._responses:
             for response in batch_response.responses:
                 if response.status.code != code_pb2.OK:
                     if response.status.code == code_pb2.RESOURCE_EXHAUSTED:
@@ -193,3 +203,13 @@ class _CASBatchUpdate:
                         "Failed to upload blob {}: {}".format(response.digest.hash, response.status.code),
                         reason=reason,
                     )
+
+    def _dispatch(self):
+        if self._request is not None:
+            # Wait for the oldest request before exceeding the limit
+            if len(self._futures) >= _MAX_CONCURRENT_REQUESTS:
+                self._responses.append(self._futures.popleft().result())
+
+            local_cas = self._remote.cascache.get_local_cas()
+            self._futures.append(local_cas.UploadMissingBlobs.future(self._request))
+            self._request = None
@@ -33,6 +33,7 @@ import stat
 from stat import S_ISDIR
 import subprocess
 from subprocess import TimeoutExpired
+import sys
 import tempfile
 import threading
 import datetime
@@ -61,6 +62,10 @@ BST_ARBITRARY_TIMESTAMP = calendar.timegm((2011, 11, 11, 11, 11, 11))
 _ALIAS_SEPARATOR = ":"
 _URI_SCHEMES = ["http", "https", "ftp", "file", "git", "sftp", "ssh"]
 
+# The size of the chunks used to read files for checksumming, this is
+# a multiple of the 64 byte block size of SHA-256
+_HASH_CHUNK_SIZE = 1024 * 1024
+
 # The process's file mode creation mask.
 # Impossible to retrieve without temporarily changing it on POSIX.
 _UMASK = os.umask(0o777)
@@ -343,10 +348,24 @@ def sha256sum(filename: str) -> str:
                   or reading `filename`
     """
     try:
-        h = hashlib.sha256()
         with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(65536), b""):
-                h.update(chunk)
+            # We read the whole file once, let the kernel read ahead aggressively.
+            # This is only a hint, which fails e.g. for pipes.
+            if hasattr(os, "posix_fadvise"):
+                try:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+
+            # hashlib.file_digest() (Python >= 3.11) reads into a single
+            # reused buffer, with fewer and larger iterations than a loop
+            # allocating a new bytes object for every chunk
+            if sys.version_info >= (3, 11):
+                h = hashlib.file_digest(f, "sha256")
+            else:
+                h = hashlib.sha256()
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+                    h.update(chunk)
 
     except OSError as e:
         raise UtilError("Failed to get a checksum of file '{}': {}".format(filename, e)) from e
@@ -378,7 +397,7 @@ def safe_copy(src: str, dest: str, *, copystat: bool = True, result: Optional[Fi
             raise UtilError("Failed to remove destination file '{}': {}".format(dest, e)) from e
 
     try:
-        shutil.copyfile(src, dest)
+        _copyfile(src, dest)
     except (OSError, shutil.Error) as e:
         raise UtilError("Failed to copy '{} -> {}': {}".format(src, dest, e)) from e
 
@@ -930,6 +949,47 @@ def _force_rmtree(rootpath):
         raise UtilError("Failed to remove cache directory '{}': {}".format(rootpath, e))
 
 
+# _copyfile()
+#
+# Like shutil.copyfile(), but copies regular files with os.copy_file_range()
+# where available (Python >= 3.8, Linux >= 4.5).
+#
+# This keeps the copy inside the kernel and allows filesystems supporting
+# reflinks, such as btrfs and xfs, to share the extents instead of copying
+# the data. We fall back to shutil.copyfile() otherwise.
+#
+# Args:
+#    src (str): The source filename
+#    dest (str): The destination filename
+#
+def _copyfile(src, dest):
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dest)
+        return
+
+    with open(src, "rb") as fsrc:
+        src_stat = os.fstat(fsrc.fileno())
+        if not stat.S_ISREG(src_stat.st_mode):
+            shutil.copyfile(src, dest)
+            return
+
+        with open(dest, "wb") as fdst:
+            # Don't trust the reported size, files may grow while being
+            # copied, and some such as those in procfs report a size of 0
+            blocksize = max(src_stat.st_size, 8 * 1024 * 1024)
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), blocksize) > 0:
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+
+            # Some filesystems return 0 rather than an error when they don't
+            # support os.copy_file_range(). The file offsets are only advanced
+            # by what was actually copied, so copy whatever is left in userspace.
+            shutil.copyfileobj(fsrc, fdst)
+
+
 # Recursively make directories in target area
 def _copy_directories(srcdir, destdir, target):
     this_dir = os.path.dirname(target)
@@ -1217,66 +1277,6 @@ def _tempnamedfile(mode="w+b", encoding=None, suffix="", prefix="tmp", dir=None)
         yield temp
 
 
-# _tempnamedfile_name()
-#
-# A context manager for doing work on a temporary file, via the filename only.
-#
-# Note that a Windows restriction prevents us from using both the file
-# descriptor and the file name of tempfile.NamedTemporaryFile, the same file
-# cannot be opened twice at the same time. This wrapper makes it easier to
-# operate in a Windows-friendly way when only filenames are needed.
-#
-# Takes care to delete the file even if interrupted by SIGTERM. Note that there
-# is a race-condition, so this is done on a best-effort basis.
-#
-# Args:
-#    dir (str): A path to a parent directory for the temporary file, this is
-#               not optional for security reasons, please see below.
-#
-# Note that 'dir' should not be a directory that may be shared with potential
-# attackers that have rights to affect the directory, e.g. the system temp
-# directory. This is because an attacker can replace the temporary file with
-# e.g. a symlink to another location, that the BuildStream user has rights to
-# but the attacker does not.
-#
-# See here for more information:
-# https://www.owasp.org/index.php/Insecure_Temporary_File
-#
-# Yields:
-#    (str): The temporary file name
-#
-@contextmanager
-def _tempnamedfile_name(dir):  # pylint: disable=redefined-builtin
-    filename = None
-
-    def rm_tempfile():
-        nonlocal filename
-        if filename is not None:
-            # Note that this code is re-entrant - it's possible for us to
-            # "delete while we're deleting" if we are responding to SIGTERM.
-            #
-            # For simplicity, choose to leak the file in this unlikely case,
-            # rather than introducing a scheme for handling the file sometimes
-            # being missing. Note that we will still leak tempfiles on forced
-            # termination anyway.
-            #
-            # Note that we must not try to delete the file more than once. If
-            # we delete the file then another temporary file can be created
-            # with the same name.
-            #
-            filename2 = filename
-            filename = None
-            os.remove(filename2)
-
-    with _signals.terminator(rm_tempfile):
-        fd, filename = tempfile.mkstemp(dir=dir)
-        os.close(fd)
-        try:
-            yield filename
-        finally:
-            rm_tempfile()
-
-
 # _kill_process_tree()
 #
 # Brutally murder a process and all of its children
@@ -1,10 +1,96 @@
 import os
+import stat
 import time
 from unittest.mock import MagicMock
 
-from buildstream._cas.cascache import CASCache
-from buildstream._cas import casdprocessmanager
+import pytest
+
+from buildstream._cas.cascache import CASCache, _BUFFER_SIZE
+from buildstream._cas.casremote import BlobNotFound, CASRemote, _MAX_CONCURRENT_REQUESTS, _MAX_PAYLOAD_BYTES
+from buildstream._cas import cascache, casdprocessmanager, casremote
+from buildstream._exceptions import CASCacheError, CASRemoteError
 from buildstream._messenger import Messenger
+from buildstream._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildstream._protos.build.buildgrid import local_cas_pb2
+from buildstream._protos.google.rpc import code_pb2
+from buildstream._remote import RemoteSpec, RemoteType
+from buildstream import utils
+
+
+# Store an object directly in the local cache, without going through casd
+def _store_object(cache, buf):
+    digest = utils._message_digest(buf)
+    objpath = cache.objpath(digest)
+    os.makedirs(os.path.dirname(objpath), exist_ok=True)
+    with open(objpath, "wb") as f:
+        f.write(buf)
+    return digest
+
+
+# Stand-in for a method of a gRPC stub, `handler` computes the response
+# for a request. Futures are only resolved when their result is asked for,
+# which allows checking how many requests are in flight at once.
+class _FakeRpc:
+    def __init__(self, handler):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._handler = handler
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return self._handler(request)
+
+    def future(self, request):
+        self.requests.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return _FakeFuture(self, request)
+
+
+class _FakeFuture:
+    def __init__(self, rpc, request):
+        self._rpc = rpc
+        self._request = request
+
+    def result(self):
+        self._rpc.in_flight -= 1
+        return self._rpc._handler(self._request)
+
+
+# Create a CASCache without buildbox-casd, with the given fake stubs
+def _fake_cascache(tmp_path, monkeypatch, *, local_cas=None, cas=None):
+    cache = CASCache(str(tmp_path.joinpath("cas")), casd=False)
+    monkeypatch.setattr(cache, "get_local_cas", lambda: local_cas)
+    monkeypatch.setattr(cache, "get_cas", lambda: cas)
+    return cache
+
+
+# Create an already initialized CASRemote for a CASCache
+def _fake_casremote(cache):
+    spec = RemoteSpec("http://localhost:50051", False, None, None, None, None, RemoteType.ALL)
+    remote = CASRemote(spec, cache)
+    remote.local_cas_instance_name = "remote"
+    remote._initialized = True
+    return remote
+
+
+# Respond to a FetchMissingBlobs or UploadMissingBlobs request,
+# with the given status for the blobs in `failed` and OK otherwise
+def _blobs_response(response_class, failed=(), code=code_pb2.NOT_FOUND):
+    def handler(request):
+        response = response_class()
+        for digest in request.blob_digests:
+            blob_response = response.responses.add()
+            blob_response.digest.CopyFrom(digest)
+            blob_response.status.code = code if digest.hash in failed else code_pb2.OK
+        return response
+
+    return handler
+
+
+def _test_digests(count):
+    return [utils._message_digest("blob {}".format(i).encode()) for i in range(count)]
 
 
 def test_report_when_cascache_dies_before_asked_to(tmp_path, monkeypatch):
@@ -106,3 +192,321 @@ def test_casd_redirects_stderr_to_file_and_rotate(tmp_path, monkeypatch):
         assert len(existing_log_files) == n_max_log_files
         assert evicted_file not in existing_log_files
         assert existing_log_files[-1].read_text() == "hello\n"
+
+
+def test_load_large_directory(tmp_path):
+    cache = CASCache(str(tmp_path.joinpath("cas")), casd=False)
+    file_digest = _store_object(cache, b"hello")
+
+    directory = remote_execution_pb2.Directory()
+    for i in range(5000):
+        filenode = directory.files.add()
+        filenode.name = "file{:05d}".format(i)
+        filenode.digest.CopyFrom(file_digest)
+
+    buf = directory.SerializeToString()
+    assert len(buf) > _BUFFER_SIZE
+    dir_digest = _store_object(cache, buf)
+
+    assert cache._load_directory(dir_digest) == directory
+
+    required_blobs = list(cache.required_blobs_for_directory(dir_digest))
+    assert required_blobs[0] == dir_digest
+    assert len(required_blobs) == 5001
+
+
+# Store a directory tree in the local cache, returning the root digest
+def _store_test_tree(cache):
+    hello_digest = _store_object(cache, b"hello")
+    script_digest = _store_object(cache, b"#!/bin/sh\n")
+
+    subdir = remote_execution_pb2.Directory()
+    filenode = subdir.files.add()
+    filenode.name = "script.sh"
+    filenode.digest.CopyFrom(script_digest)
+    filenode.is_executable = True
+    subdir_digest = _store_object(cache, subdir.SerializeToString())
+
+    root = remote_execution_pb2.Directory()
+    filenode = root.files.add()
+    filenode.name = "hello.txt"
+    filenode.digest.CopyFrom(hello_digest)
+    dirnode = root.directories.add()
+    dirnode.name = "bin"
+    dirnode.digest.CopyFrom(subdir_digest)
+    symlinknode = root.symlinks.add()
+    symlinknode.name = "link"
+    symlinknode.target = "bin/script.sh"
+
+    return _store_object(cache, root.SerializeToString())
+
+
+@pytest.mark.parametrize("can_link", [True, False], ids=["link", "copy"])
+def test_checkout(tmp_path, can_link):
+    cache = CASCache(str(tmp_path.joinpath("cas")), casd=False)
+    root_digest = _store_test_tree(cache)
+
+    dest = tmp_path.joinpath("checkout")
+    cache.checkout(str(dest), root_digest, can_link=can_link)
+
+    assert sorted(os.listdir(str(dest))) == ["bin", "hello.txt", "link"]
+    assert dest.joinpath("hello.txt").read_bytes() == b"hello"
+    assert os.readlink(str(dest.joinpath("link"))) == "bin/script.sh"
+
+    script = dest.joinpath("bin", "script.sh")
+    assert script.read_bytes() == b"#!/bin/sh\n"
+    assert script.stat().st_mode & stat.S_IXUSR
+    assert not dest.joinpath("hello.txt").stat().st_mode & stat.S_IXUSR
+
+
+def test_checkout_missing_blob(tmp_path):
+    cache = CASCache(str(tmp_path.joinpath("cas")), casd=False)
+
+    root = remote_execution_pb2.Directory()
+    filenode = root.files.add()
+    filenode.name = "missing.txt"
+    filenode.digest.CopyFrom(utils._message_digest(b"not in the cache"))
+    root_digest = _store_object(cache, root.SerializeToString())
+
+    with pytest.raises(utils.UtilError):
+        cache.checkout(str(tmp_path.joinpath("checkout")), root_digest)
+
+
+def test_fetch_blobs_limits_requests_in_flight(tmp_path, monkeypatch):
+    fetch_missing_blobs = _FakeRpc(_blobs_response(local_cas_pb2.FetchMissingBlobsResponse))
+    local_cas = MagicMock(FetchMissingBlobs=fetch_missing_blobs)
+    cache = _fake_cascache(tmp_path, monkeypatch, local_cas=local_cas)
+    remote = _fake_casremote(cache)
+    monkeypatch.setattr(casremote, "_MAX_DIGESTS", 2)
+
+    digests = _test_digests(100)
+    assert cache.fetch_blobs(remote, digests) is None
+
+    assert len(fetch_missing_blobs.requests) == 50
+    assert fetch_missing_blobs.max_in_flight == _MAX_CONCURRENT_REQUESTS
+    assert fetch_missing_blobs.in_flight == 0
+    assert [d for request in fetch_missing_blobs.requests for d in request.blob_digests] == digests
+    assert all(request.instance_name == "remote" for request in fetch_missing_blobs.requests)
+
+
+def test_send_blobs_limits_requests_in_flight(tmp_path, monkeypatch):
+    upload_missing_blobs = _FakeRpc(_blobs_response(local_cas_pb2.UploadMissingBlobsResponse))
+    local_cas = MagicMock(UploadMissingBlobs=upload_missing_blobs)
+    cache = _fake_cascache(tmp_path, monkeypatch, local_cas=local_cas)
+    remote = _fake_casremote(cache)
+    monkeypatch.setattr(casremote, "_MAX_DIGESTS", 2)
+
+    digests = _test_digests(100)
+    cache.send_blobs(remote, digests)
+
+    assert len(upload_missing_blobs.requests) == 50
+    assert upload_missing_blobs.max_in_flight == _MAX_CONCURRENT_REQUESTS
+    assert upload_missing_blobs.in_flight == 0
+    assert [d for request in upload_missing_blobs.requests for d in request.blob_digests] == digests
+
+
+def test_fetch_blobs_allow_partial(tmp_path, monkeypatch):
+    digests = _test_digests(4)
+    missing = {digests[1].hash, digests[3].hash}
+
+    fetch_missing_blobs = _FakeRpc(_blobs_response(local_cas_pb2.FetchMissingBlobsResponse, missing))
+    cache = _fake_cascache(tmp_path, monkeypatch, local_cas=MagicMock(FetchMissingBlobs=fetch_missing_blobs))
+    remote = _fake_casremote(cache)
+
+    missing_blobs = cache.fetch_blobs(remote, digests, allow_partial=True)
+    assert missing_blobs == [digests[1], digests[3]]
+
+
+def test_fetch_blobs_missing(tmp_path, monkeypatch):
+    digests = _test_digests(4)
+
+    fetch_missing_blobs = _FakeRpc(_blobs_response(local_cas_pb2.FetchMissingBlobsResponse, {digests[2].hash}))
+    cache = _fake_cascache(tmp_path, monkeypatch, local_cas=MagicMock(FetchMissingBlobs=fetch_missing_blobs))
+    remote = _fake_casremote(cache)
+
+    with pytest.raises(BlobNotFound) as exc:
+        cache.fetch_blobs(remote, digests)
+    assert exc.value.blob == digests[2].hash
+
+
+def test_fetch_blobs_error(tmp_path, monkeypatch):
+    digests = _test_digests(4)
+
+    fetch_missing_blobs = _FakeRpc(
+        _blobs_response(local_cas_pb2.FetchMissingBlobsResponse, {digests[2].hash}, code=code_pb2.UNAVAILABLE)
+    )
+    cache = _fake_cascache(tmp_path, monkeypatch, local_cas=MagicMock(FetchMissingBlobs=fetch_missing_blobs))
+    remote = _fake_casremote(cache)
+
+    # Only blobs which are not found can be skipped
+    with pytest.raises(CASRemoteError) as exc:
+        cache.fetch_blobs(remote, digests, allow_partial=True)
+    assert not isinstance(exc.value, BlobNotFound)
+
+
+# Respond to a BatchUpdateBlobs request, with the given status for
+# the blobs in `failed` and OK otherwise
+def _batch_update_response(failed=(), code=code_pb2.RESOURCE_EXHAUSTED):
+    def handler(request):
+        response = remote_execution_pb2.BatchUpdateBlobsResponse()
+        for blob_request in request.requests:
+            assert utils._message_digest(blob_request.data) == blob_request.digest
+            blob_response = response.responses.add()
+            blob_response.digest.CopyFrom(blob_request.digest)
+            blob_response.status.code = code if blob_request.digest.hash in failed else code_pb2.OK
+        return response
+
+    return handler
+
+
+def _capture_files_response(request):
+    response = local_cas_pb2.CaptureFilesResponse()
+    for path in request.path:
+        with open(path, "rb") as f:
+            digest = utils._message_digest(f.read())
+        blob_response = response.responses.add()
+        blob_response.path = path
+        blob_response.digest.CopyFrom(digest)
+        blob_response.status.code = code_pb2.OK
+    return response
+
+
+def test_add_buffers(tmp_path, monkeypatch):
+    batch_update_blobs = _FakeRpc(_batch_update_response())
+    capture_files = _FakeRpc(_capture_files_response)
+    cache = _fake_cascache(
+        tmp_path,
+        monkeypatch,
+        local_cas=MagicMock(CaptureFiles=capture_files),
+        cas=MagicMock(BatchUpdateBlobs=batch_update_blobs),
+    )
+
+    # Two of these don't fit in a single request
+    buffers = [os.urandom(_MAX_PAYLOAD_BYTES // 2 + 1) for _ in range(3)]
+    buffers.append(b"small")
+    buffers.append(os.urandom(_MAX_PAYLOAD_BYTES))
+
+    digests = cache.add_objects(buffers=buffers, instance_name="remote")
+
+    assert digests == [utils._message_digest(buffer) for buffer in buffers]
+    assert not capture_files.requests
+
+    requests = batch_update_blobs.requests
+    assert [len(request.requests) for request in requests] == [1, 1, 2, 1]
+    assert [blob_request.data for request in requests for blob_request in request.requests] == buffers
+    assert all(request.instance_name == "remote" for request in requests)
+
+
+def test_add_buffers_too_large(tmp_path, monkeypatch):
+    batch_update_blobs = _FakeRpc(_batch_update_response())
+    capture_files = _FakeRpc(_capture_files_response)
+    cache = _fake_cascache(
+        tmp_path,
+        monkeypatch,
+        local_cas=MagicMock(CaptureFiles=capture_files),
+        cas=MagicMock(BatchUpdateBlobs=batch_update_blobs),
+    )
+
+    # All buffers are captured from files if one of them doesn't fit in a request
+    buffers = [b"small", os.urandom(_MAX_PAYLOAD_BYTES + 1)]
+
+    digests = cache.add_objects(buffers=buffers)
+
+    assert digests == [utils._message_digest(buffer) for buffer in buffers]
+    assert not batch_update_blobs.requests
+    assert len(capture_files.requests) == 1
+    assert len(capture_files.requests[0].path) == 2
+
+
+@pytest.mark.parametrize(
+    "code,reason", [(code_pb2.RESOURCE_EXHAUSTED, "cache-too-full"), (code_pb2.INTERNAL, None)], ids=["full", "error"]
+)
+def test_add_buffers_error(tmp_path, monkeypatch, code, reason):
+    buffers = [b"first", b"second"]
+    failed = {utils._message_digest(b"second").hash}
+
+    batch_update_blobs = _FakeRpc(_batch_update_response(failed, code=code))
+    cache = _fake_cascache(tmp_path, monkeypatch, cas=MagicMock(BatchUpdateBlobs=batch_update_blobs))
+
+    with pytest.raises(CASCacheError) as exc:
+        cache.add_objects(buffers=buffers)
+    assert exc.value.reason == reason
+
+
+# Respond to a FindMissingBlobs request, reporting the blobs in `missing`
+def _find_missing_response(missing):
+    def handler(request):
+        response = remote_execution_pb2.FindMissingBlobsResponse()
+        for digest in request.blob_digests:
+            if digest.hash in missing:
+                response.missing_blob_digests.add().CopyFrom(digest)
+        return response
+
+    return handler
+
+
+def test_missing_blobs(tmp_path, monkeypatch):
+    digests = _test_digests(2000)
+    missing = [digests[1], digests[1500]]
+
+    find_missing_blobs = _FakeRpc(_find_missing_response({d.hash for d in missing}))
+    cache = _fake_cascache(tmp_path, monkeypatch, cas=MagicMock(FindMissingBlobs=find_missing_blobs))
+    remote = _fake_casremote(cache)
+
+    assert list(cache.missing_blobs(digests, remote=remote)) == missing
+    assert [len(request.blob_digests) for request in find_missing_blobs.requests] == [512, 512, 512, 464]
+    assert all(request.instance_name == "remote" for request in find_missing_blobs.requests)
+
+    # Remote blobs are checked again every time
+    assert list(cache.missing_blobs(digests[:2], remote=remote)) == missing[:1]
+    assert len(find_missing_blobs.requests) == 5
+
+    # Without a remote, the local cache is queried
+    assert list(cache.missing_blobs(digests[:2])) == missing[:1]
+    assert find_missing_blobs.requests[-1].instance_name == ""
+
+
+# Fetch a Tree with a single subdirectory through fake casd stubs
+def _fetch_test_tree(tmp_path, monkeypatch):
+    fetch_missing_blobs = _FakeRpc(_blobs_response(local_cas_pb2.FetchMissingBlobsResponse))
+    batch_update_blobs = _FakeRpc(_batch_update_response())
+    cache = _fake_cascache(
+        tmp_path,
+        monkeypatch,
+        local_cas=MagicMock(FetchMissingBlobs=fetch_missing_blobs),
+        cas=MagicMock(BatchUpdateBlobs=batch_update_blobs),
+    )
+    remote = _fake_casremote(cache)
+
+    tree = remote_execution_pb2.Tree()
+    child = tree.children.add()
+    child.files.add(name="file", digest=utils._message_digest(b"file"))
+    tree.root.directories.add(name="child", digest=utils._message_digest(child.SerializeToString()))
+    tree_digest = _store_object(cache, tree.SerializeToString())
+
+    root_digest = cache._fetch_tree(remote, tree_digest)
+    assert root_digest == utils._message_digest(tree.root.SerializeToString())
+
+    return cache, tree, root_digest
+
+
+def test_fetch_tree_caches_directories(tmp_path, monkeypatch):
+    cache, tree, root_digest = _fetch_test_tree(tmp_path, monkeypatch)
+    child = tree.children[0]
+
+    # The directories were sent to casd and are now served from memory
+    # without reading them from disk, which the fake casd doesn't write to
+    assert not os.path.exists(cache.objpath(root_digest))
+    assert cache._load_directory(root_digest) == tree.root
+    assert list(cache.required_blobs_for_directory(root_digest)) == [
+        root_digest,
+        tree.root.directories[0].digest,
+        child.files[0].digest,
+    ]
+
+
+def test_fetch_tree_too_large_to_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cascache, "_DIRECTORY_CACHE_SIZE", 1)
+
+    cache, _, _ = _fetch_test_tree(tmp_path, monkeypatch)
+    assert not cache._directory_cache
@@ -0,0 +1,83 @@
+import errno
+import os
+import pytest
+
+from buildstream import utils
+from buildstream.utils import safe_copy
+
+
+def _write_file(path, contents):
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_safe_copy(tmpdir):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    contents = os.urandom(3 * 1024 * 1024 + 17)
+    _write_file(src, contents)
+
+    safe_copy(src, dest)
+
+    assert _read_file(dest) == contents
+
+
+def test_safe_copy_empty_file(tmpdir):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    _write_file(src, b"")
+
+    safe_copy(src, dest)
+
+    assert _read_file(dest) == b""
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="Requires procfs")
+def test_safe_copy_file_reporting_no_size(tmpdir):
+    # Files in procfs report a size of 0 but do have contents
+    dest = os.path.join(str(tmpdir), "dest")
+    assert os.stat("/proc/self/status").st_size == 0
+
+    safe_copy("/proc/self/status", dest)
+
+    assert _read_file(dest).startswith(b"Name:")
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="Requires os.copy_file_range()")
+def test_safe_copy_copy_file_range_unsupported(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    contents = os.urandom(1024 * 1024)
+    _write_file(src, contents)
+
+    # Some filesystems return 0 rather than an error
+    monkeypatch.setattr(utils.os, "copy_file_range", lambda *args: 0)
+    safe_copy(src, dest)
+    assert _read_file(dest) == contents
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="Requires os.copy_file_range()")
+def test_safe_copy_copy_file_range_fails_midway(tmpdir, monkeypatch):
+    src = os.path.join(str(tmpdir), "src")
+    dest = os.path.join(str(tmpdir), "dest")
+    contents = os.urandom(1024 * 1024)
+    _write_file(src, contents)
+
+    copy_file_range = os.copy_file_range
+    calls = []
+
+    # Copy part of the file, then fail as across filesystems
+    def partial_copy_file_range(src_fd, dst_fd, count):
+        calls.append(count)
+        if len(calls) > 1:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return copy_file_range(src_fd, dst_fd, 4096)
+
+    monkeypatch.setattr(utils.os, "copy_file_range", partial_copy_file_range)
+    safe_copy(src, dest)
+    assert _read_file(dest) == contents